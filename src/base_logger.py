@@ -1,17 +1,33 @@
 #!/usr/local/bin/python3
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 logger = logging.getLogger(__name__)
 
-log_dir = '/app/logs/migration.log'
+log_dir = os.getenv('LOG_FILE', '/app/logs/migration.log')
+log_format = '%(asctime)s - %(name)s - %(levelname)s - [%(filename)-30s%(funcName)20s():%(lineno)03s] %(message)s'
+
+# File writes happen on a background listener thread so logging calls don't block on disk IO.
+# Records are written as soon as the listener picks them up rather than being held back in a buffer.
+rotating_handler = RotatingFileHandler(log_dir, maxBytes=1048576, backupCount=5)
+rotating_handler.setFormatter(logging.Formatter(log_format))
+file_handler = QueueHandler(queue.SimpleQueue())
+# Only merge the message and traceback here; the full format is applied once by rotating_handler
+file_handler.setFormatter(logging.Formatter('%(message)s'))
+file_listener = QueueListener(file_handler.queue, rotating_handler)
+file_listener.start()
+# Drain whatever is still queued before the interpreter exits
+atexit.register(file_listener.stop)
 
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - [%(filename)-30s%(funcName)20s():%(lineno)03s] %(message)s',
+    format=log_format,
     handlers=[
             logging.StreamHandler(),
-            RotatingFileHandler(log_dir, maxBytes=1048576, backupCount=5)
+            file_handler
     ]
 )
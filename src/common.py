@@ -1,20 +1,64 @@
 #!/usr/local/bin/python3
-from typing import Dict
+from typing import Dict, Optional, Union
+from dataclasses import dataclass, field
 from base_logger import logger
-from dateutil.parser import parse
 from datetime import datetime, timedelta, date
 from enum import Enum
+import functools
+import threading
 import os
 import json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_loads(p_data: bytes):
+    """Deserialise JSON, using orjson when it is installed"""
+    return orjson.loads(p_data) if orjson else json.loads(p_data)
+
+
+def json_dumps(p_obj) -> bytes:
+    """Serialise to UTF-8 encoded JSON, using orjson when it is installed"""
+    return orjson.dumps(p_obj) if orjson else json.dumps(p_obj).encode("utf-8")
+
+
+def _dateutil_parse(p_value: str) -> datetime:
+    """Heuristic parse for non ISO-8601 values; dateutil is only imported the first time it is needed"""
+    from dateutil.parser import parse
+    return parse(p_value)
+
+
+def parse_iso_datetime(p_value: str) -> datetime:
+    """Parse an ISO-8601 date/time string, falling back to dateutil for anything non-standard"""
+    try:
+        return datetime.fromisoformat(p_value)
+    except ValueError:
+        return _dateutil_parse(p_value)
+
 
 def get_datetime_from_entry(entry: Dict) -> datetime:
-    """Extract datetime from entry dictionary"""
+    """Extract datetime from entry dictionary, caching it in the entry under '_dt' so it is only derived once"""
+    entry_datetime = entry.get('_dt')
+    if entry_datetime is None:
+        entry_datetime = entry['_dt'] = _parse_datetime_from_entry(entry)
+    return entry_datetime
+
+
+def _parse_datetime_from_entry(entry: Dict) -> datetime:
     if 'date' in entry:
+        entry_time = entry.get('time', '08:00:00')
+        try:
+            # Fitbit entries are always YYYY-MM-DD / HH:MM:SS, so build the datetime in a single strict parse
+            return datetime.fromisoformat(f"{entry['date']}T{entry_time}")
+        except ValueError:
+            pass
+
         try:
             # Create datetime object
-            entry_date = parse(entry['date'])
-            entry_time = entry.get('time', '08:00:00')
+            entry_date = _dateutil_parse(entry['date'])
             
             # Parse time and combine with date
             time_parts = entry_time.split(':')
@@ -45,8 +89,16 @@ class MIGRATION_TYPE(Enum):
     GOOGLE_FIT = 2
     OMRON = 3
 
+# Key in STATE_FILE holding the last migrated date for each migration type
+_STATE_KEYS = {
+    MIGRATION_TYPE.FITBIT: 'last_fitbit_migration_date',
+    MIGRATION_TYPE.GOOGLE_FIT: 'last_google_fit_migration_date',
+    MIGRATION_TYPE.OMRON: 'last_omron_migration_date',
+}
+
+@functools.lru_cache(maxsize=1)
 def get_version() -> str:
-    """Get the version of the application"""
+    """Get the version of the application (read once, it can't change while the process is running)"""
     try:
         with open(VERSION_FILE, 'r') as f:
             return f.read().strip()
@@ -54,34 +106,45 @@ def get_version() -> str:
         logger.exception(f"Error reading version file: {e}")
         return '0.0.0'
 
+# Parsed contents of STATE_FILE, populated on first read and kept in step by save_migration_state
+_state_cache = None
+_state_lock = threading.Lock()
+
+def invalidate_migration_state():
+    """Discard the cached migration state so the next read goes back to the state file"""
+    global _state_cache
+    with _state_lock:
+        _state_cache = None
+
+def _load_migration_state() -> Dict:
+    """Return the cached migration state, reading STATE_FILE only on first use. The caller must hold _state_lock."""
+    global _state_cache
+    if _state_cache is None:
+        try:
+            if os.path.exists(STATE_FILE):
+                with open(STATE_FILE, 'rb') as f:
+                    _state_cache = json_loads(f.read())
+                    logger.info(f"Loaded migration state file!")
+            else:
+                _state_cache = {}
+        except Exception as e:
+            logger.exception(f"Error reading state file {STATE_FILE}: {e}")
+
+    return _state_cache
+
 def get_migration_state() -> Dict:
-    try:
-        if os.path.exists(STATE_FILE):
-            with open(STATE_FILE, 'r') as f:
-                state = json.load(f)
-                logger.info(f"Loaded migration state file!")
-                return state
-    except Exception as e:
-        logger.exception(f"Error reading state file {STATE_FILE}: {e}")
-        
-    return None
+    with _state_lock:
+        return _load_migration_state() or None
 
 def get_last_migration_date(p_item: MIGRATION_TYPE) -> datetime:
     """Get the last migration date from state file"""
     
     state = get_migration_state() or {}
     try:
-        _dateValue = None
-        if p_item == MIGRATION_TYPE.FITBIT:
-            # For Fitbit, use the last migration date
-            _dateValue = state.get('last_fitbit_migration_date', None)
-        elif p_item == MIGRATION_TYPE.GOOGLE_FIT:
-            _dateValue = state.get('last_google_fit_migration_date', None)
-        elif p_item == MIGRATION_TYPE.OMRON:
-            _dateValue = state.get('last_omron_migration_date', None)
+        _dateValue = state.get(_STATE_KEYS[p_item], None)
 
         if _dateValue is not None:
-            return parse(_dateValue)
+            return parse_iso_datetime(_dateValue)
 
         return None
     
@@ -91,62 +154,126 @@ def get_last_migration_date(p_item: MIGRATION_TYPE) -> datetime:
     return None
 
 
-def save_migration_state(p_item: MIGRATION_TYPE, last_date: datetime):
-    """Save the last migration date to state file"""
+def save_migration_state(p_item: MIGRATION_TYPE, last_date: datetime, durable: bool = False):
+    """Save the last migration date to state file.
+
+    The file is written to a temporary file and renamed over the original so a crash can never leave
+    a half written state file. Pass durable=True to also fsync it to disk, e.g. at the end of a batch.
+    """
+    global _state_cache
     
-    state = get_migration_state() or {}
-    if p_item == MIGRATION_TYPE.FITBIT:
-        state['last_fitbit_migration_date'] = last_date.isoformat()
-    elif p_item == MIGRATION_TYPE.GOOGLE_FIT:
-        state['last_google_fit_migration_date'] = last_date.isoformat()
-    elif p_item == MIGRATION_TYPE.OMRON:
-        state['last_omron_migration_date'] = last_date.isoformat()
+    # Hold the lock for the whole read-modify-write so concurrent saves can't drop each other's keys
+    with _state_lock:
+        state = dict(_load_migration_state() or {})
+        state[_STATE_KEYS[p_item]] = last_date.isoformat()
+        if not _write_migration_state(state, durable):
+            return
+        _state_cache = state
+    logger.info(f"Saved migration state: {p_item} {last_date}")
 
+
+def _write_migration_state(state: Dict, durable: bool) -> bool:
     try:
-        os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
-        with open(STATE_FILE, 'w') as f:
-            json.dump(state, f)
-        logger.info(f"Saved migration state: {p_item} {last_date}")
+        state_dir = os.path.dirname(STATE_FILE)
+        tmp_file = f"{STATE_FILE}.tmp"
+        os.makedirs(state_dir, exist_ok=True)
+        with open(tmp_file, 'wb') as f:
+            f.write(json_dumps(state))
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_file, STATE_FILE)
     except Exception as e:
         logger.exception(f"Error saving state file {STATE_FILE}: {e}")
+        return False
+
+    if durable:
+        # Make sure the rename itself has reached the disk. The new state is already in place at this
+        # point, so a directory that can't be fsynced (e.g. some bind mounts) doesn't fail the save.
+        try:
+            dir_fd = os.open(state_dir, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        except OSError as e:
+            logger.warning(f"Could not fsync state directory {state_dir}: {e}")
+    return True
+
+
+@dataclass(frozen=True)
+class Config:
+    """Credentials for each service, taken from a single snapshot of the environment"""
+    fitbit_client_id: Optional[str] = None
+    fitbit_client_secret: Optional[str] = field(default=None, repr=False)
+    garmin_email: Optional[str] = None
+    garmin_password: Optional[str] = field(default=None, repr=False)
+    omron_email: Optional[str] = None
+    omron_password: Optional[str] = field(default=None, repr=False)
+    omron_country_code: Optional[str] = None
+    omron_user_number: Union[str, int] = -1
+
+    @property
+    def fitbit_configured(self) -> bool:
+        # TODO - add the check to ensure the token file exists as well!
+        return bool(self.fitbit_client_id and self.fitbit_client_secret)
+
+    @property
+    def garmin_configured(self) -> bool:
+        return bool(self.garmin_email and self.garmin_password)
+
+    @property
+    def omron_configured(self) -> bool:
+        return bool(self.omron_email and self.omron_password and self.omron_country_code)
+
 
+# The environment doesn't change for the lifetime of the process, so it is read once on first use
+# (rather than at import, so that any load_dotenv() by the caller is picked up).
+@functools.lru_cache(maxsize=1)
+def get_config() -> Config:
+    environ = dict(os.environ)
+    return Config(
+        fitbit_client_id=environ.get('FITBIT_CLIENT_ID') or None,
+        fitbit_client_secret=environ.get('FITBIT_CLIENT_SECRET') or None,
+        garmin_email=environ.get('GARMIN_EMAIL') or None,
+        garmin_password=environ.get('GARMIN_PASSWORD') or None,
+        omron_email=environ.get('OMRON_EMAIL') or None,
+        omron_password=environ.get('OMRON_PASSWORD') or None,
+        omron_country_code=environ.get('OMRON_COUNTRY_CODE') or None,
+        omron_user_number=environ.get('OMRON_USER_NUMBER') or -1,
+    )
 
 def isFitbitConfigured() -> bool:
     """Check if Fitbit credentials are configured"""
-    client_id = os.getenv('FITBIT_CLIENT_ID')
-    client_secret = os.getenv('FITBIT_CLIENT_SECRET')
-    # TODO - add the check to ensure the token file exists as well!
-    return bool(client_id and client_secret)
+    return get_config().fitbit_configured
 
 def getFitbitCredentials() -> Dict:
+    config = get_config()
     return {
-            'client_id': os.getenv('FITBIT_CLIENT_ID') if os.getenv('FITBIT_CLIENT_ID') else None,
-            'client_secret': os.getenv('FITBIT_CLIENT_SECRET') if os.getenv('FITBIT_CLIENT_SECRET') else None
+            'client_id': config.fitbit_client_id,
+            'client_secret': config.fitbit_client_secret
         }
 
 def isGarminConfigured() -> bool:
     """Check if Garmin credentials are configured"""
-    email = os.getenv('GARMIN_EMAIL')
-    password = os.getenv('GARMIN_PASSWORD')
-    return bool(email and password)
+    return get_config().garmin_configured
 
 def getGarminCredentials() -> Dict:
+    config = get_config()
     return {
-            'email': os.getenv('GARMIN_EMAIL') if os.getenv('GARMIN_EMAIL') else None,
-            'password': os.getenv('GARMIN_PASSWORD') if os.getenv('GARMIN_PASSWORD') else None
+            'email': config.garmin_email,
+            'password': config.garmin_password
         }
 
 def isOmronConfigured() -> bool:
     """Check if Omron credentials are configured"""
-    email_address = os.getenv('OMRON_EMAIL')
-    password = os.getenv('OMRON_PASSWORD')
-    country_code = os.getenv('OMRON_COUNTRY_CODE')
-    return bool(email_address and password and country_code)
+    return get_config().omron_configured
 
 def getOmronCredentials() -> Dict:
+    config = get_config()
     return {
-            'email': os.getenv('OMRON_EMAIL') if os.getenv('OMRON_EMAIL') else None,
-            'password': os.getenv('OMRON_PASSWORD') if os.getenv('OMRON_PASSWORD') else None,
-            'country_code': os.getenv('OMRON_COUNTRY_CODE') if os.getenv('OMRON_COUNTRY_CODE') else None,
-            'user_number': os.getenv('OMRON_USER_NUMBER') if os.getenv('OMRON_USER_NUMBER') else -1
+            'email': config.omron_email,
+            'password': config.omron_password,
+            'country_code': config.omron_country_code,
+            'user_number': config.omron_user_number
         }
@@ -1,7 +1,10 @@
 #!/usr/local/bin/python3
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+import threading
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
 
 from base_logger import logger  
@@ -10,11 +13,36 @@ import common
 
 FITBIT_BASE = "https://api.fitbit.com"
 TOKEN_FILE = "/app/data/fitbit_tokens.json"
+WEIGHT_URL_TEMPLATE = FITBIT_BASE + "/1/user/-/body/log/weight/date/{}/{}.json"
+
+FETCH_WORKERS = 3           # Number of weight windows fetched concurrently
+RATE_LIMIT_HEADROOM = 10    # Start spacing requests out once this few calls remain in the rate limit window
 
 class FitbitAPI:
     def __init__(self, _client_id: str, _client_secret: str):
+        self._session = self.create_session()
+        self._token_lock = threading.Lock()
+        self._throttle_lock = threading.Lock()
+        self._next_request_at = 0.0
+        self._rl_remaining = None
+        self._rl_reset_at = None
         self.setup_credentials(_client_id, _client_secret)
 
+    def create_session(self) -> requests.Session:
+        """Create a pooled HTTP session so connections to the Fitbit API are reused between calls"""
+        session = requests.Session()
+        # Once the retries are used up, hand back the last 5xx response so the callers' status handling deals with it
+        retries = Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504], raise_on_status=False)
+        session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retries))
+        return session
+
+    def set_access_token(self, _access_token: str):
+        self.access_token = _access_token
+        if _access_token:
+            self._session.headers["Authorization"] = f"Bearer {_access_token}"
+        else:
+            self._session.headers.pop("Authorization", None)
+
     def setup_credentials(self, _client_id: str, _client_secret: str):
         self.client_id = _client_id
         self.client_secret = _client_secret
@@ -22,8 +50,8 @@ class FitbitAPI:
             logger.error("Fitbit clientId and client secret must be provided.")
             raise ValueError("Fitbit clientId and client secret must be provided.")
 
-        tokens = self.load_tokens()
-        self.access_token = tokens.get('access_token')
+        tokens = self.load_tokens() or {}
+        self.set_access_token(tokens.get('access_token'))
         self.refresh_token = tokens.get('refresh_token')
 
         required_vars = ['access_token', 'refresh_token']
@@ -35,24 +63,26 @@ class FitbitAPI:
 
     def load_tokens(self):
         try:
-            with open(TOKEN_FILE, "r") as f:
-                return json.load(f)
+            with open(TOKEN_FILE, "rb") as f:
+                tokens = common.json_loads(f.read())
             logger.info(f"Successfully loaded tokens from {TOKEN_FILE}")
-        except Exception as e:
+            return tokens
+        except (OSError, ValueError) as e:
             logger.exception(f"Failed to load token file: {TOKEN_FILE}. Please ensure it exists and is valid JSON. {e}")
+        return None
 
 
     def save_tokens(self, tokens):
         try:
-            with open(TOKEN_FILE, "w") as f:
-                json.dump(tokens, f)
+            with open(TOKEN_FILE, "wb") as f:
+                f.write(common.json_dumps(tokens))
                 logger.info(f"Successfully saved tokens to {TOKEN_FILE}")
         except Exception as e:
             logger.exception(f"Failed to save tokens to {TOKEN_FILE}. Please check file permissions and path. {e}")
 
         
     def refresh_fitbit_token(self):
-        response = requests.post(
+        response = self._session.post(
             f"{FITBIT_BASE}/oauth2/token",
             data={
                 "grant_type": "refresh_token",
@@ -71,7 +101,7 @@ class FitbitAPI:
 
         self.save_tokens(new_tokens)
         
-        self.access_token = new_tokens.get("access_token")
+        self.set_access_token(new_tokens.get("access_token"))
         self.refresh_token = new_tokens.get("refresh_token")
 
         return new_tokens["access_token"]
@@ -81,37 +111,80 @@ class FitbitAPI:
         return self.access_token or self.refresh_fitbit_token()
 
 
+    def refresh_stale_token(self, _stale_token: str):
+        """Refresh the access token unless another worker has already replaced the stale one"""
+        with self._token_lock:
+            if self.access_token == _stale_token:
+                self.refresh_fitbit_token()
+
+
+    def update_rate_limits(self, response):
+        """Record the rate limit state Fitbit reports with every response"""
+        try:
+            remaining = int(response.headers["fitbit-rate-limit-remaining"])
+            reset = int(response.headers["fitbit-rate-limit-reset"])
+        except (KeyError, ValueError):
+            return
+        with self._throttle_lock:
+            self._rl_remaining = remaining
+            # Keep the reset as an absolute deadline, the relative value goes stale as soon as it is read
+            self._rl_reset_at = time.monotonic() + reset
+
+
+    def throttle(self):
+        """Block until the shared rate limiter allows the next request.
+
+        Requests go out immediately while there is plenty of headroom in Fitbit's rate limit; once it
+        runs low, the remaining calls are spread evenly over the time left until the limit resets.
+        """
+        with self._throttle_lock:
+            now = time.monotonic()
+            wait = self._next_request_at - now
+            delay = 0.0
+            if self._rl_reset_at is not None and now >= self._rl_reset_at:
+                # The window has reset since the last response, so the recorded quota no longer applies
+                self._rl_remaining = None
+                self._rl_reset_at = None
+            if self._rl_remaining is not None and self._rl_remaining <= RATE_LIMIT_HEADROOM:
+                delay = (self._rl_reset_at - now) / max(self._rl_remaining, 1)
+            self._next_request_at = max(now, self._next_request_at) + delay
+        if wait > 0:
+            time.sleep(wait)
+
+
     def handle_fitbit_rate_limits(self, response) -> bool:
         if response.status_code == 429:
             reset_time = int(response.headers.get("fitbit-rate-limit-reset", 60))
             logger.info(f"Rate limit hit. Sleeping for {reset_time} seconds.")
+            # Hold back the other workers as well, rather than letting them hit the limit too
+            with self._throttle_lock:
+                self._next_request_at = max(self._next_request_at, time.monotonic() + reset_time)
+                # The window will have reset once the sleep is over, so don't spread requests on top of it
+                self._rl_remaining = None
+                self._rl_reset_at = None
             time.sleep(reset_time)
             return True
         return False
 
 
-    def get_fitbit_body_data(self, p_start_date: datetime, p_end_date: datetime):
+    def get_fitbit_weight_window(self, p_start_date: datetime, p_end_date: datetime):
+        """Fetch the raw weight log entries for a single (at most 30 day) window"""
         current_date = p_start_date
-        p_end_date = p_end_date
-        all_data = []
+        end_str = p_end_date.date().isoformat()
 
         while current_date < p_end_date:
-            end_date = (current_date + timedelta(days=30))
-            if end_date > p_end_date:
-                end_date = p_end_date
-
-            start_str = current_date.strftime("%Y-%m-%d")
-            end_str = end_date.strftime("%Y-%m-%d")
+            start_str = current_date.date().isoformat()
+            url = WEIGHT_URL_TEMPLATE.format(start_str, end_str)
 
-            token = self.get_fitbit_access_token()
-            url = f"{FITBIT_BASE}/1/user/-/body/log/weight/date/{start_str}/{end_str}.json"
-            headers = {"Authorization": f"Bearer {token}"}
-            response = requests.get(url, headers=headers)
+            self.throttle()
+            token = self.access_token
+            response = self._session.get(url)
 
             if response.status_code == 401:
-                token = self.refresh_fitbit_token()
-                headers["Authorization"] = f"Bearer {token}"
-                response = requests.get(url, headers=headers)
+                self.refresh_stale_token(token)
+                response = self._session.get(url)
+
+            self.update_rate_limits(response)
 
             if self.handle_fitbit_rate_limits(response):
                 continue
@@ -121,38 +194,45 @@ class FitbitAPI:
                 current_date += timedelta(days=1)
                 continue
 
-            data = response.json().get("weight", [])
-            if data:
-                all_data.extend(data)
-                
-            time.sleep(0.5)  # polite delay
+            return response.json().get("weight", [])
+
+        return []
+
+
+    def get_fitbit_body_data(self, p_start_date: datetime, p_end_date: datetime):
+        windows = []
+        current_date = p_start_date
+        while current_date < p_end_date:
+            end_date = min(current_date + timedelta(days=30), p_end_date)
+            windows.append((current_date, end_date))
             current_date += timedelta(days=30)
 
-        # Process the data to ensure it is in the correct format
+        self.get_fitbit_access_token()
+
+        # The windows are I/O bound, so overlap them; map() keeps the results in window (date) order.
+        # Each window is filtered and converted as it arrives so the raw pages aren't kept around.
         ret_data = []
-        for entry in all_data: 
-            
-            # Only add entries where the entry's date time objects are after the last migration date/time 
-            if common.get_datetime_from_entry(entry) <= p_start_date:
-                logger.debug(f"Skipping entry {entry} as it is before the start date {p_start_date}")
-                continue
-            
-            if entry.get('body_fat'):
-                body_fat = round(entry['body_fat'], 2)
-            elif entry.get('fat'):
-                body_fat = round(entry['fat'], 2)
-            else:
-                body_fat = None
-            
-            ret_entry = {
-                "date": entry["date"],
-                "time": entry.get("time", "08:00:00"),
-                "weight": round(entry["weight"], 2),
-                "bmi": round(entry.get("bmi", 0), 2),
-                "body_fat": body_fat,
-            }
-            
-            ret_data.append(ret_entry)
+        with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+            for data in executor.map(lambda window: self.get_fitbit_weight_window(*window), windows):
+                for entry in data:
+
+                    # Only add entries where the entry's date time objects are after the last migration date/time 
+                    entry_datetime = common.get_datetime_from_entry(entry)
+                    if entry_datetime <= p_start_date:
+                        logger.debug("Skipping entry %s as it is before the start date %s", entry, p_start_date)
+                        continue
+
+                    body_fat = entry.get('body_fat') or entry.get('fat')
+
+                    ret_data.append({
+                        "date": entry["date"],
+                        "time": entry.get("time", "08:00:00"),
+                        "weight": round(entry["weight"], 2),
+                        "bmi": round(entry.get("bmi", 0), 2),
+                        "body_fat": round(body_fat, 2) if body_fat else None,
+                        # Carry the parsed datetime over so the migrator doesn't parse the date/time again
+                        "_dt": entry_datetime,
+                    })
 
         return ret_data
 
@@ -160,18 +240,18 @@ class FitbitAPI:
     def check_fitbit_profile(self) -> bool:
 
         url = f"{FITBIT_BASE}/1/user/-/profile.json"
-        token = self.get_fitbit_access_token()
-        headers = {"Authorization": f"Bearer {token}"}
+        self.get_fitbit_access_token()
 
-        response = requests.get(url, headers=headers)
+        response = self._session.get(url)
 
         if response.status_code == 401:
-            token = self.refresh_fitbit_token()
-            headers["Authorization"] = f"Bearer {token}"
-            response = requests.get(url, headers=headers)
+            self.refresh_fitbit_token()
+            response = self._session.get(url)
+
+        self.update_rate_limits(response)
 
         if self.handle_fitbit_rate_limits(response):
-            response = requests.get(url, headers=headers)
+            response = self._session.get(url)
 
         if response.status_code == 200:
             return True
@@ -1,22 +1,53 @@
 #!/usr/local/bin/python3
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from garth.exc import GarthHTTPError
-import json
+import logging
+import random
+import threading
+import time
+import os
 
 from base_logger import logger  
+import common
 
 from garminconnect import (
     Garmin,
     GarminConnectAuthenticationError,
+    GarminConnectTooManyRequestsError,
 )
 
 
 
 TOKEN_FILE = "/app/data/garmin_tokens"
+MAX_UPLOAD_INTERVAL = 30.0  # Upper bound (seconds) on the spacing between uploads after repeated rate limiting
+MIN_UPLOAD_INTERVAL = 0.2   # Spacing (seconds) applied after the first rate limit response
+MAX_RETRIES = 5             # Attempts made for a rate limited upload before giving up
+BACKOFF_BASE = 1.0          # Initial backoff (seconds) after a rate limit response, doubled on each retry
+
+
+def gmt_to_epoch(p_timestamp: str) -> float:
+    """Convert a naive Garmin GMT timestamp (e.g. 2024-01-31T07:15:00.0) to a POSIX timestamp"""
+    return datetime.fromisoformat(p_timestamp).replace(tzinfo=timezone.utc).timestamp()
+
+
+def is_rate_limited(p_error: Exception) -> bool:
+    """Check whether an exception from the Garmin client is an HTTP 429 response"""
+    if isinstance(p_error, GarminConnectTooManyRequestsError):
+        return True
+    if isinstance(p_error, GarthHTTPError):
+        response = getattr(p_error.error, "response", None)
+        return response is not None and response.status_code == 429
+    return False
+
 
 class GarminAPI:
     def __init__(self, _email: str, _password: str):
         self._garmin_client = None
+        self._tokens = None
+        self._tokens_file_key = None
+        self._throttle_lock = threading.Lock()
+        self._next_upload_at = 0.0
+        self._upload_interval = 0.0
         self.setup_credentials(_email, _password)
 
     def setup_credentials(self, _email: str, _password: str):
@@ -29,19 +60,27 @@ class GarminAPI:
 
     def load_tokens(self):
         try:
-            with open(TOKEN_FILE, "r") as f:
-                return json.load(f)
+            # Only re-read the token file when it has changed on disk since it was last loaded
+            stat = os.stat(TOKEN_FILE)
+            file_key = (stat.st_mtime_ns, stat.st_size)
+            if self._tokens is not None and self._tokens_file_key == file_key:
+                return self._tokens
+
+            with open(TOKEN_FILE, "rb") as f:
+                self._tokens = common.json_loads(f.read())
+            self._tokens_file_key = file_key
             logger.info(f"Successfully loaded tokens from {TOKEN_FILE}")
+            return self._tokens
         except FileNotFoundError:
             logger.debug(f"Token file {TOKEN_FILE} not found.")
-        except Exception as e:
+        except (OSError, ValueError) as e:
             logger.exception(f"Failed to load token file: {TOKEN_FILE}. Please ensure it exists and is valid JSON. {e}")   
         return None
 
     def save_tokens(self, tokens) -> bool:
         try:
-            with open(TOKEN_FILE, "w") as f:
-                json.dump(tokens, f)
+            with open(TOKEN_FILE, "wb") as f:
+                f.write(common.json_dumps(tokens))
                 logger.info(f"Successfully saved tokens to {TOKEN_FILE}")
         except Exception as e:
             logger.exception(f"Failed to save tokens to {TOKEN_FILE}. Please check file permissions and path. {e}")
@@ -50,6 +89,10 @@ class GarminAPI:
         return False
 
     def login(self) -> bool:
+        if self._garmin_client is not None:
+            # Keep using the existing session rather than authenticating again
+            return True
+
         try:
             # Try to connect using (possibly) cached OAuth2 tokens
             tokens = self.load_tokens()
@@ -82,33 +125,67 @@ class GarminAPI:
             except Exception as e:
                 logger.exception(f"Garmin login failed: {e}")
 
+        self._garmin_client = None
         return False
 
+    def throttle(self):
+        """Block until the next upload is allowed.
+
+        Uploads go out back to back while Garmin is accepting them; after a rate limit response they are
+        spaced out across all threads, and the spacing decays again as uploads succeed.
+        """
+        with self._throttle_lock:
+            now = time.monotonic()
+            wait = self._next_upload_at - now
+            self._next_upload_at = max(now, self._next_upload_at) + self._upload_interval
+        if wait > 0:
+            time.sleep(wait)
+
+    def call_with_backoff(self, func, **kwargs):
+        """Call a Garmin upload method, retrying with exponential backoff and jitter when rate limited"""
+        for attempt in range(MAX_RETRIES + 1):
+            self.throttle()
+            try:
+                result = func(**kwargs)
+            except Exception as e:
+                if not is_rate_limited(e) or attempt == MAX_RETRIES:
+                    raise
+                delay = BACKOFF_BASE * 2 ** attempt + random.uniform(0, BACKOFF_BASE)
+                logger.warning(f"Garmin rate limit hit, retrying in {delay:.1f} seconds")
+                with self._throttle_lock:
+                    self._upload_interval = min(max(self._upload_interval * 2, MIN_UPLOAD_INTERVAL), MAX_UPLOAD_INTERVAL)
+                    self._next_upload_at = max(self._next_upload_at, time.monotonic() + delay)
+                continue
+
+            with self._throttle_lock:
+                self._upload_interval = self._upload_interval / 2 if self._upload_interval > MIN_UPLOAD_INTERVAL else 0.0
+            return result
+
     def set_blood_pressure(self, p_systolic: int, p_diastolic: int, p_pulse: int, p_timestamp: datetime, p_notes: str) -> bool:
         try:
             timestamp = p_timestamp.isoformat()
 
-            results = self._garmin_client.set_blood_pressure(systolic=p_systolic, diastolic=p_diastolic, pulse=p_pulse, timestamp=timestamp, notes=p_notes)
+            results = self.call_with_backoff(self._garmin_client.set_blood_pressure, systolic=p_systolic, diastolic=p_diastolic, pulse=p_pulse, timestamp=timestamp, notes=p_notes)
             
             if results:
-                metrics = []
-                if p_systolic:
-                    metrics.append(f"systolic: {p_systolic}")
-                if p_diastolic:
-                    metrics.append(f"diastolic: {p_diastolic}")
-                if p_pulse:
-                    metrics.append(f"pulse: {p_pulse}")
-                if p_notes:
-                    metrics.append(f"Notes: {p_notes}")
-
-                logger.info(f"Successfully uploaded {', '.join(metrics)} for {timestamp}")
+                # Per-entry detail is DEBUG only; the migrator logs progress summaries at INFO
+                if logger.isEnabledFor(logging.DEBUG):
+                    metrics = []
+                    if p_systolic:
+                        metrics.append(f"systolic: {p_systolic}")
+                    if p_diastolic:
+                        metrics.append(f"diastolic: {p_diastolic}")
+                    if p_pulse:
+                        metrics.append(f"pulse: {p_pulse}")
+                    if p_notes:
+                        metrics.append(f"Notes: {p_notes}")
+
+                    logger.debug(f"Successfully uploaded {', '.join(metrics)} for {timestamp}")
                 return True
                 
             else:
-                logger.warning(f"Failed to upload body data for {timestamp}")            
+                logger.warning(f"Failed to upload blood pressure data for {timestamp}")            
 
-            logger.info(f"Successfully set blood pressure to {p_systolic}/{p_diastolic} at {p_timestamp}")
-            
         except Exception as e:
             logger.exception(f"Failed to set blood pressure: {e}")
             
@@ -121,39 +198,35 @@ class GarminAPI:
         
         gcData = self._garmin_client.get_blood_pressure(startdate=fromDate, enddate=toDate)
         
-        # reduce to list of measurements
-        _gcMeasurements = [metric for x in gcData["measurementSummaries"] for metric in x["measurements"]]        
-        
-        # map of garmin-key:omron-key
-        gcMeasurements = []
-        for metric in _gcMeasurements:
-            # use UTC for comparison
-            dtUTC = datetime.fromisoformat(f"{metric['measurementTimestampGMT']}Z")
-            gcMeasurements.append({
+        # flatten the daily summaries straight into garmin-key:omron-key measurements, using UTC for comparison
+        return [
+            {
                 "systolic": metric["systolic"],
                 "diastolic": metric["diastolic"],
                 "pulse": metric["pulse"],
-                "measurementTimestamp": dtUTC.timestamp()
-            })
-        
-        return gcMeasurements
+                "measurementTimestamp": gmt_to_epoch(metric["measurementTimestampGMT"])
+            }
+            for summary in gcData["measurementSummaries"] for metric in summary["measurements"]
+        ]
     
     def add_body_composition(self, p_timestamp: datetime, p_weight: float, p_bmi: float = None, p_body_fat: float = None) -> int:
         try:
             timestamp = p_timestamp.isoformat()             
             # Upload to Garmin using the body composition method
-            result = self._garmin_client.add_body_composition(weight=p_weight, bmi=p_bmi, percent_fat=p_body_fat, timestamp=timestamp)
+            result = self.call_with_backoff(self._garmin_client.add_body_composition, weight=p_weight, bmi=p_bmi, percent_fat=p_body_fat, timestamp=timestamp)
             
             if result:
-                metrics = []
-                if p_weight:
-                    metrics.append(f"weight: {p_weight}kg")
-                if p_bmi:
-                    metrics.append(f"BMI: {p_bmi}")
-                if p_body_fat:
-                    metrics.append(f"body fat: {p_body_fat}%")
-                
-                logger.info(f"Successfully uploaded {', '.join(metrics)} for {timestamp}")
+                # Per-entry detail is DEBUG only; the migrator logs progress summaries at INFO
+                if logger.isEnabledFor(logging.DEBUG):
+                    metrics = []
+                    if p_weight:
+                        metrics.append(f"weight: {p_weight}kg")
+                    if p_bmi:
+                        metrics.append(f"BMI: {p_bmi}")
+                    if p_body_fat:
+                        metrics.append(f"body fat: {p_body_fat}%")
+                    
+                    logger.debug(f"Successfully uploaded {', '.join(metrics)} for {timestamp}")
                 
                 return True
 
@@ -1,28 +1,80 @@
 #!/usr/local/bin/python3
 import sys
-import fitbit_api as fitbit
-import omron_api as omron
+import os
+import time
 from base_logger import logger
 import common
 
+# Load environment variables before common.get_config() takes its snapshot of them
+from dotenv import load_dotenv
+load_dotenv()
+
+# Successful service checks are remembered for a while so that every Docker probe doesn't hit the external APIs
+# No shorter-lived "recently OK" marker sits in front of this: Docker only probes every 5 minutes (see the
+# HEALTHCHECK in the Dockerfile), so a marker that expires sooner than that would never be fresh when checked
+CACHE_FILE = '/app/data/healthcheck_cache.json'
+DEFAULT_CACHE_SECONDS = 900
+
+
+def load_cache() -> dict:
+    try:
+        with open(CACHE_FILE, 'rb') as f:
+            return common.json_loads(f.read())
+    except Exception:
+        return {}
+
+def save_cache(cache: dict):
+    try:
+        with open(CACHE_FILE, 'wb') as f:
+            f.write(common.json_dumps(cache))
+    except Exception as e:
+        logger.warning(f"Failed to save healthcheck cache {CACHE_FILE}: {e}")
+
+def get_cache_seconds() -> int:
+    """How long a successful service check is remembered, from HEALTHCHECK_CACHE_SECONDS"""
+    value = os.getenv('HEALTHCHECK_CACHE_SECONDS', str(DEFAULT_CACHE_SECONDS))
+    try:
+        return int(value)
+    except ValueError:
+        logger.warning(f"Invalid HEALTHCHECK_CACHE_SECONDS '{value}', using {DEFAULT_CACHE_SECONDS}")
+        return DEFAULT_CACHE_SECONDS
+
+def is_fresh(cache: dict, service: str, cache_seconds: int) -> bool:
+    return time.time() - cache.get(service, 0) < cache_seconds
+
+
 def main():
     try:
         
         if not common.isGarminConfigured():
             sys.exit(1)
 
-        if common.isFitbitConfigured():
+        cache = load_cache()
+        cache_seconds = get_cache_seconds()
+        cache_changed = False
+
+        if common.isFitbitConfigured() and not is_fresh(cache, 'fitbit', cache_seconds):
+            import fitbit_api as fitbit
             fitbitCredentials = common.getFitbitCredentials()
 
             fitbit_client = fitbit.FitbitAPI(fitbitCredentials['client_id'], fitbitCredentials['client_secret'])
             if not fitbit_client.check_fitbit_profile():
                 sys.exit(1)
+            cache['fitbit'] = time.time()
+            cache_changed = True
          
-        if common.isOmronConfigured():
+        if common.isOmronConfigured() and not is_fresh(cache, 'omron', cache_seconds):
+            import omron_api as omron
             omronCredentials = common.getOmronCredentials()
             omron_client = omron.OmronAPI(omronCredentials['email'], omronCredentials['password'], omronCredentials['country_code'], omronCredentials['user_number'])
             if not omron_client.getUserData():
                 sys.exit(1)
+            cache['omron'] = time.time()
+            cache_changed = True
+
+        # Nothing to write when every check was answered from the cache
+        if cache_changed:
+            save_cache(cache)
 
     except Exception as e: 
         sys.exit(1)
@@ -30,4 +82,4 @@ def main():
 
 
 if __name__ == "__main__":
-    exit(main())
\ No newline at end of file
+    exit(main())
@@ -4,12 +4,11 @@ Body Composition Migration - Fitbit to Garmin
 Migrates weight, BMI, and body fat percentage data from Fitbit to Garmin Connect
 """
 
-import debugpy
 import os
 from datetime import datetime, timezone
-from typing import Dict, List, Optional
-import time
-from dateutil.parser import parse
+from typing import Dict, Iterable, Iterator, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+import threading
 from dotenv import load_dotenv
 
 import omron_api as omron
@@ -25,27 +24,33 @@ load_dotenv()
 # Enable debugging if specified in environment variables
 debug = os.getenv('DEBUG', 'false').lower() in ('true', '1', 't')
 if debug:
+    # debugpy is heavy to import, so only load it when debugging is actually enabled
+    import debugpy
     debugpy.listen(('0.0.0.0', 5678))
 #    debugpy.wait_for_client()
     logger.info("Debugging (not) enabled")
 
+UPLOAD_WORKERS = 4      # Number of entries uploaded to Garmin concurrently
+UPLOAD_QUEUE_SIZE = 64  # Maximum number of entries waiting to be uploaded
+UPLOAD_LOG_INTERVAL = 50    # Log an upload progress summary every this many entries
+
 
 class BodyCompositionMigrator:
     def __init__(self):
         self._garmin_client = None
         self._fitbit_client = None
         self._omron_client = None
+        self._config = common.get_config()
 
     def connect_garmin(self) -> bool:
         """Initialize Garmin client"""
         try:
-            if not common.isGarminConfigured():
+            if not self._config.garmin_configured:
                 logger.error("Garmin credentials not configured")
                 return False
             
             # Garmin credentials
-            garminCredentials = common.getGarminCredentials()
-            self._garmin_client = garmin.GarminAPI(garminCredentials['email'], garminCredentials['password'])
+            self._garmin_client = garmin.GarminAPI(self._config.garmin_email, self._config.garmin_password)
             if self._garmin_client.login():
                 logger.info("Successfully connected to Garmin")
                 return True
@@ -63,12 +68,11 @@ class BodyCompositionMigrator:
     def connect_fitbit(self) -> bool:
         """Initialize Fitbit client"""
         try:
-            if not common.isFitbitConfigured():
+            if not self._config.fitbit_configured:
                 logger.error("Fitbit credentials not configured")
                 return False
 
-            fitbitCredentials = common.getFitbitCredentials()
-            self._fitbit_client = fitbit.FitbitAPI(fitbitCredentials['client_id'], fitbitCredentials['client_secret'])
+            self._fitbit_client = fitbit.FitbitAPI(self._config.fitbit_client_id, self._config.fitbit_client_secret)
             if not self._fitbit_client.check_fitbit_profile():
                 logger.error("Failed to connect to Fitbit: Invalid profile")
                 return False
@@ -82,12 +86,11 @@ class BodyCompositionMigrator:
     def connect_omron(self) -> bool:
         """Initialize Omron client"""
         try:
-            if not common.isOmronConfigured():
+            if not self._config.omron_configured:
                 logger.error("Omron credentials not configured")
                 return False
             
-            omronCredentials = common.getOmronCredentials()
-            self._omron_client = omron.OmronAPI(omronCredentials['email'], omronCredentials['password'], omronCredentials['country_code'], omronCredentials['user_number'])
+            self._omron_client = omron.OmronAPI(self._config.omron_email, self._config.omron_password, self._config.omron_country_code, self._config.omron_user_number)
             if not self._omron_client._login():
                 logger.error("Failed to connect to Omron: Invalid credentials")
                 return False
@@ -111,91 +114,115 @@ class BodyCompositionMigrator:
             return []
 
 
-    def trim_allready_existing_bp_data(self, _gc_bp_data: List[Dict], _omron_bp_data: List[Dict]) -> List[Dict]:
-        """Remove allready existing data from the list of body composition data"""
+    def trim_allready_existing_bp_data(self, _gc_bp_data: List[Dict], _omron_bp_data: Iterable[Dict]) -> Iterator[Dict]:
+        """Remove allready existing data from the stream of blood pressure data"""
         logger.info(f"Reviewing Omron blood pressure measurements and removing any that already exist in Garmin!")
-        trimmed_data = []
+        # Compare on integer epoch milliseconds rather than rebuilding timestamps from the Omron datetimes
+        gc_timestamps_ms = {round(gcMeasurement['measurementTimestamp'] * 1000) for gcMeasurement in _gc_bp_data}
+        trimmed = 0
         for entry in _omron_bp_data:
-            entry_datetime = common.get_datetime_from_entry(entry)
-            if not any(gcMeasurement['measurementTimestamp'] == entry_datetime.timestamp() for gcMeasurement in _gc_bp_data):
-                trimmed_data.append(entry)
-        logger.info(f"Trimmed {len(_omron_bp_data) - len(trimmed_data)} blood pressure entries from Omron data!")
-        return trimmed_data
+            if entry['measurementTimestampMs'] in gc_timestamps_ms:
+                trimmed += 1
+                continue
+            yield entry
+        logger.info(f"Trimmed {trimmed} blood pressure entries from Omron data!")
     
 
-    def upload_blood_pressure_data_to_garmin(self, blood_pressure_data: List[Dict]) -> int:
-        """Upload blood pressure data to Garmin Connect"""
+    def upload_concurrently(self, entries: Iterable[Dict], upload_entry) -> int:
+        """Upload entries to Garmin on a small thread pool, returning the number uploaded successfully.
+
+        entries may be a lazy iterable (e.g. readings still being paged in from Omron); it is consumed on
+        this thread while the workers upload, with at most UPLOAD_QUEUE_SIZE entries waiting at any time.
+        The Garmin client spaces out the requests itself, so its rate limit holds across all the workers.
+        """
         successful_uploads = 0
 
         if not self._garmin_client:
             logger.error("Garmin client not initialized")
 
         else:
-            for entry in blood_pressure_data:
+            queued = threading.BoundedSemaphore(UPLOAD_QUEUE_SIZE)
+            progress_lock = threading.Lock()
+            progress = {'done': 0, 'uploaded': 0}
+
+            def upload(entry: Dict):
+                uploaded = False
                 try:
-                    entry_datetime = common.get_datetime_from_entry(entry)
-                    
-                    notes = entry.get('notes', '')
-                    if entry.get('movementDetect', False):
-                        notes = f"{notes}, Body Movement detected"
-                    if entry.get('irregularHB', False):
-                        notes = f"{notes}, Irregular heartbeat detected"
-                    if not entry.get('cuffWrapDetect', True):
-                        notes = f"{notes}, Cuff wrap error"
-                        
-                    if notes:
-                        notes = notes.lstrip(", ")
-                    
-                    # Upload to Garmin using the blood pressure method
-                    if self._garmin_client.set_blood_pressure(
-                            p_timestamp=entry_datetime,
-                            p_systolic=int(entry['systolic']) if entry.get('systolic') else None,
-                            p_diastolic=int(entry['diastolic']) if entry.get('diastolic') else None,
-                            p_pulse=int(entry['pulse']) if entry.get('pulse') else None,
-                            p_notes=notes
-                        ):
-                        successful_uploads += 1
-                        logger.info(f"Successfully uploaded blood pressure data for {entry_datetime}") 
-                            
-                    time.sleep(0.2)  # Rate limiting            
-                    
+                    uploaded = upload_entry(entry)
                 except Exception as e:
-                    logger.exception(f"Error uploading body composition entry {entry}: {e}")
-        
+                    logger.exception(f"Error uploading entry {entry}: {e}")
+                finally:
+                    queued.release()
+                    with progress_lock:
+                        progress['done'] += 1
+                        progress['uploaded'] += 1 if uploaded else 0
+                        if progress['done'] % UPLOAD_LOG_INTERVAL == 0:
+                            logger.info(f"Uploaded {progress['uploaded']}/{progress['done']} entries so far, last: {common.get_datetime_from_entry(entry)}")
+
+            # Futures aren't kept: results are counted in upload(), so memory stays bounded by the queue size
+            with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+                for entry in entries:
+                    queued.acquire()
+                    executor.submit(upload, entry)
+
+            successful_uploads = progress['uploaded']
+
         return successful_uploads
-    
 
-    def upload_body_comp_data_to_garmin(self, body_data: List[Dict]) -> int:
-        """Upload body composition data to Garmin Connect"""
-        successful_uploads = 0
+
+    def upload_blood_pressure_entry(self, entry: Dict) -> bool:
+        """Upload a single blood pressure reading to Garmin Connect"""
+        entry_datetime = common.get_datetime_from_entry(entry)
         
-        if not self._garmin_client:
-            logger.error("Garmin client not initialized")
+        notes = entry.get('notes', '')
+        parts = [notes] if notes else []
+        if entry.get('movementDetect', False):
+            parts.append("Body Movement detected")
+        if entry.get('irregularHB', False):
+            parts.append("Irregular heartbeat detected")
+        if not entry.get('cuffWrapDetect', True):
+            parts.append("Cuff wrap error")
+        notes = ", ".join(parts)
+        
+        # Upload to Garmin using the blood pressure method
+        if self._garmin_client.set_blood_pressure(
+                p_timestamp=entry_datetime,
+                p_systolic=int(entry['systolic']) if entry.get('systolic') else None,
+                p_diastolic=int(entry['diastolic']) if entry.get('diastolic') else None,
+                p_pulse=int(entry['pulse']) if entry.get('pulse') else None,
+                p_notes=notes
+            ):
+            logger.debug("Successfully uploaded blood pressure data for %s", entry_datetime)
+            return True
 
-        else:        
-            for entry in body_data:
-                try:
-                    # Skip entries with no data
-                    if not any([entry.get('weight'), entry.get('bmi'), entry.get('body_fat')]):
-                        continue
-                    
-                    entry_datetime = common.get_datetime_from_entry(entry)
-                    
-                    # Upload to Garmin using the body composition method
-                    if self._garmin_client.add_body_composition(
-                            p_timestamp=entry_datetime, 
-                            p_weight=entry.get('weight') if entry.get('weight') else None, 
-                            p_bmi=entry.get('bmi') if entry.get('bmi') else None, 
-                            p_body_fat=entry.get('body_fat') if entry.get('body_fat') else None
-                            ):
-                        successful_uploads += 1
-                            
-                    time.sleep(0.2)  # Rate limiting
-                    
-                except Exception as e:
-                    logger.exception(f"Error uploading body composition entry {entry}: {e}")
+        return False
+
+
+    def upload_blood_pressure_data_to_garmin(self, blood_pressure_data: Iterable[Dict]) -> int:
+        """Upload blood pressure data to Garmin Connect"""
+        return self.upload_concurrently(blood_pressure_data, self.upload_blood_pressure_entry)
+    
+
+    def upload_body_comp_entry(self, entry: Dict) -> bool:
+        """Upload a single body composition entry to Garmin Connect"""
+        # Skip entries with no data
+        if not (entry.get('weight') or entry.get('bmi') or entry.get('body_fat')):
+            return False
         
-        return successful_uploads
+        entry_datetime = common.get_datetime_from_entry(entry)
+        
+        # Upload to Garmin using the body composition method
+        return self._garmin_client.add_body_composition(
+                p_timestamp=entry_datetime, 
+                p_weight=entry.get('weight') if entry.get('weight') else None, 
+                p_bmi=entry.get('bmi') if entry.get('bmi') else None, 
+                p_body_fat=entry.get('body_fat') if entry.get('body_fat') else None
+                )
+
+
+    def upload_body_comp_data_to_garmin(self, body_data: List[Dict]) -> int:
+        """Upload body composition data to Garmin Connect"""
+        return self.upload_concurrently(body_data, self.upload_body_comp_entry)
 
     def get_garmin_bp_measurements(self, _from_date: datetime, _to_date: datetime):
         
@@ -212,9 +239,7 @@ class BodyCompositionMigrator:
         if not p_data:
             return None
 
-        item = max(p_data, key=common.get_datetime_from_entry)
-
-        return common.get_datetime_from_entry(item)
+        return max(map(common.get_datetime_from_entry, p_data))
 
 
     def fitbit2garmin_migrate_body_composition(self):
@@ -246,9 +271,14 @@ class BodyCompositionMigrator:
             return True
         
         # Log summary of data found
-        weight_count = sum(1 for entry in body_data if entry.get('weight'))
-        bmi_count = sum(1 for entry in body_data if entry.get('bmi'))
-        fat_count = sum(1 for entry in body_data if entry.get('body_fat'))
+        weight_count = bmi_count = fat_count = 0
+        for entry in body_data:
+            if entry.get('weight'):
+                weight_count += 1
+            if entry.get('bmi'):
+                bmi_count += 1
+            if entry.get('body_fat'):
+                fat_count += 1
         
         logger.info(f"Found: {weight_count} weight entries, {bmi_count} BMI entries, {fat_count} body fat entries")
         
@@ -266,7 +296,7 @@ class BodyCompositionMigrator:
         else:
             end_date = start_date
 
-        common.save_migration_state(MIGRATION_TYPE.FITBIT, end_date)
+        common.save_migration_state(MIGRATION_TYPE.FITBIT, end_date, durable=True)
 
         return successful_uploads > 0
 
@@ -294,34 +324,51 @@ class BodyCompositionMigrator:
         # omronUD = self._omron_client.getUserData()
         # TODO - get the TZ from here... Could use the connection country_code to determine the timezone as well!
 
-        # Fetch blood pressure data from Omron
-        omron_bp_data = self._omron_client.getBloodPressureData(lastSyncedTime=int(start_date.timestamp())*1000)
+        # Fetch the measurements Garmin already has up front, so that Omron readings can be checked as they arrive
+        gc_pb_data = self.get_garmin_bp_measurements(start_date, end_date) or []
+
+        readings = {'count': 0, 'new': 0, 'last_recorded_date': None}
+
+        def omron_readings() -> Iterator[Dict]:
+            """Stream readings from Omron, noting how many were read and the latest measurement date"""
+            for entry in self._omron_client.getBloodPressureData(lastSyncedTime=int(start_date.timestamp())*1000):
+                readings['count'] += 1
+                entry_datetime = common.get_datetime_from_entry(entry)
+                if readings['last_recorded_date'] is None or entry_datetime > readings['last_recorded_date']:
+                    readings['last_recorded_date'] = entry_datetime
+                yield entry
+
+        def new_readings() -> Iterator[Dict]:
+            for entry in self.trim_allready_existing_bp_data(_gc_bp_data=gc_pb_data, _omron_bp_data=omron_readings()):
+                readings['new'] += 1
+                yield entry
+
+        # Upload to Garmin while further Omron pages are still being fetched
+        try:
+            successful_uploads = self.upload_blood_pressure_data_to_garmin(new_readings())
+        except omron.OmronFetchError as e:
+            # Readings on the missing pages would be skipped for good if the state moved past them
+            logger.error(f"Omron fetch did not complete, migration state not updated: {e}")
+            return False
 
-        if not omron_bp_data:
+        if not readings['count']:
             logger.info("No blood pressure data found to migrate")
             return True
 
         # Get the last recorded datetime from the read metrics
-        last_recorded_date = self.get_latest_recorded_date(omron_bp_data)
-
-        gc_pb_data = self.get_garmin_bp_measurements(start_date, end_date)
-        if gc_pb_data:
-            omron_bp_data = self.trim_allready_existing_bp_data(_gc_bp_data=gc_pb_data, _omron_bp_data=omron_bp_data)
+        last_recorded_date = readings['last_recorded_date']
 
-        if not omron_bp_data:
+        if not readings['new']:
             logger.info("No blood pressure data found to migrate")
             if gc_pb_data:
                 # Save migration state
-                common.save_migration_state(MIGRATION_TYPE.OMRON, last_recorded_date)
+                common.save_migration_state(MIGRATION_TYPE.OMRON, last_recorded_date, durable=True)
             return True
 
         # Log summary of data found
-        logger.info(f"Found: {len(omron_bp_data)} blood pressure entries")
-
-        # Upload to Garmin
-        successful_uploads = self.upload_blood_pressure_data_to_garmin(omron_bp_data)
+        logger.info(f"Found: {readings['new']} blood pressure entries")
 
-        logger.info(f"Migration completed: {successful_uploads}/{len(omron_bp_data)} entries uploaded successfully")
+        logger.info(f"Migration completed: {successful_uploads}/{readings['new']} entries uploaded successfully")
 
         # Update the end_date to the last recorded date in the data. If no data provided, use the start_date.
         if last_recorded_date:
@@ -330,7 +377,7 @@ class BodyCompositionMigrator:
             end_date = start_date
 
         # Save migration state
-        common.save_migration_state(MIGRATION_TYPE.OMRON, end_date)
+        common.save_migration_state(MIGRATION_TYPE.OMRON, end_date, durable=True)
 
         return successful_uploads > 0
 
@@ -340,22 +387,23 @@ def main():
     try:
         logger.info(f"Starting migration process with version {common.get_version()}")
         migrator = BodyCompositionMigrator()
+        config = common.get_config()
 
-        if common.isGarminConfigured():
+        if config.garmin_configured:
             if migrator.connect_garmin():
                 logger.info("Garmin connection successful")
             else:
                 logger.error("Failed to connect to Garmin. Aborting migration.")
                 return 1
 
-        if common.isFitbitConfigured():
+        if config.fitbit_configured:
             success = migrator.fitbit2garmin_migrate_body_composition()
             if success:
                 logger.info("Fitbit2Garmin Body composition migration completed successfully")
             else:
                 logger.error("Fitbit2Garmin Body composition migration failed")
 
-        if common.isOmronConfigured():
+        if config.omron_configured:
             success = migrator.omron2garmin_migrate_blood_pressure()
             if success:
                 logger.info("Omron2Garmin blood pressure migration completed successfully")
@@ -1,11 +1,12 @@
 #!/usr/local/bin/python3
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 import requests
+from requests.adapters import HTTPAdapter
 import hashlib
 import enum
-import pytz
-import json
+import functools
 import common
 
 from base_logger import logger
@@ -15,6 +16,15 @@ from base_logger import logger
 from dotenv import load_dotenv
 load_dotenv()
 
+@functools.lru_cache(maxsize=64)
+def _fixed_offset(minutes: int) -> timezone:
+    """Shared fixed-offset timezone for a UTC offset in minutes"""
+    return timezone(timedelta(minutes=minutes))
+
+class OmronFetchError(Exception):
+    """Raised when a page of OMRON data fails to load, so the readings fetched so far are incomplete"""
+
+
 class DeviceCategory(enum.StrEnum):
     BPM = "0"
     SCALE = "1"
@@ -48,6 +58,17 @@ class OmronAPI():
         self._refresh_token = None
         self._expires_at = None
         self._lastSyncTime = 0
+        self._login_payload = None
+        self._session = self.create_session()
+
+    def create_session(self) -> requests.Session:
+        """
+        Create a pooled HTTP session so connections to the Omron server are reused between calls.
+        """
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4))
+        session.headers["user-agent"] = self._USER_AGENT
+        return session
 
     def get_server(self, _country_code: str):
         """
@@ -61,6 +82,13 @@ class OmronAPI():
         # Default return north america server!
         return "https://oi-api.ohiomron.com"
 
+    def _encodeLoginPayload(self, data: dict):
+        """
+        Serialise a login request body, returning it with the checksum the OMRON API expects.
+        """
+        rawData = common.json_dumps(data)
+        return rawData, hashlib.sha256(rawData).hexdigest()
+
     def _login(self) -> bool:
         
         if self._access_token and self._expires_at and datetime.now() < self._expires_at:
@@ -70,42 +98,41 @@ class OmronAPI():
         
         else:
             
-            data = {}
-            
             if not self._access_token:
                 # No access token, perform login
                 logger.info("No access token, performing login")
-                data = {
-                    "emailAddress": self._email_address,
-                    "app": self._APP_NAME,
-                    "country": self._country_code,
-                    "password": self._password,
-                }
+                if self._login_payload is None:
+                    # The initial login request never changes, so only serialise and hash it once
+                    self._login_payload = self._encodeLoginPayload({
+                        "emailAddress": self._email_address,
+                        "app": self._APP_NAME,
+                        "country": self._country_code,
+                        "password": self._password,
+                    })
+                rawData, checksum = self._login_payload
               
             else:
                 # We have an access and refresh token, need to refresh the login.
-                data = {
+                rawData, checksum = self._encodeLoginPayload({
                     "app": self._APP_NAME,
                     "emailAddress": self._email_address,
                     "refreshToken": self._refresh_token,
-                }
+                })
 
-            rawData = json.dumps(data).encode("utf-8")
             headers = {
-                "user-agent": self._USER_AGENT,
                 "content-type": "application/json",
                 "Cache-Control": "no-cache",
-                "Checksum": hashlib.sha256(rawData).hexdigest()
+                "Checksum": checksum
             }
 
             url = f"{self._server}{self._APP_URL}/login"
             try:
-                resp = requests.post(url, data=rawData, headers=headers)
+                resp = self._session.post(url, data=rawData, headers=headers)
                 if resp.status_code != 200:
                     logger.error(f"Login failed with status code {resp.status_code}")
                     return False
                 else:
-                    ret = resp.json()
+                    ret = common.json_loads(resp.content)
                     try:
                         self._access_token = ret["accessToken"]
                         self._refresh_token = ret["refreshToken"]
@@ -139,34 +166,30 @@ class OmronAPI():
             return None
         
         url = f"{self._server}{self._APP_URL}/user?app={self._APP_NAME}"
-        resp = requests.get(url, headers=self._getAuthHeaders())
+        resp = self._session.get(url, headers=self._getAuthHeaders())
         if resp.status_code != 200:
             logger.error(f"Failed to fetch user data: {resp.status_code}")
             return None
 
-        return resp.json()
+        return common.json_loads(resp.content)
 
-    def getBloodPressureData(self, nextpaginationKey: int = 0, lastSyncedTime: int = 0, phoneIdentifier: str = ""):
+    def _getBloodPressurePage(self, nextpaginationKey: int, lastSyncedTime: int, phoneIdentifier: str):
         """
-        Fetch blood pressure data from the OMRON Connect API
+        Fetch a single page of blood pressure data from the OMRON Connect API
         """
-        if self._login() == False:
-            logger.error("Login failed. Please check your credentials.")
-            return None
-        
         _lastSyncedTime = "" if lastSyncedTime <= 0 else lastSyncedTime
         url = f"{self._server}{self._APP_URL}/v2/sync/bp?nextpaginationKey={nextpaginationKey}&lastSyncedTime={_lastSyncedTime}&phoneIdentifier={phoneIdentifier}"
         
         bpData = {}
         
         try:
-            resp = requests.get(url, headers=self._getAuthHeaders())
+            resp = self._session.get(url, headers=self._getAuthHeaders())
             if resp.status_code != 200:
                 logger.error(f"Failed to fetch blood pressure data: {resp.status_code}")
                 return None
             else:
                 logger.info(f"Fetched blood pressure data successfully: {resp.status_code}")
-                bpData = resp.json()
+                bpData = common.json_loads(resp.content)
         except requests.RequestException as err:
             logger.error(f"An error occurred: {err}")
             return None
@@ -177,49 +200,86 @@ class OmronAPI():
         if bpData["success"] == False:
             logger.error(f"Failed to fetch blood pressure data: {bpData['message']} {bpData['errorCode']}")
             return None
+
+        return bpData
+
+    def _parseBloodPressureReading(self, reading):
+        """
+        Convert a raw OMRON reading into a blood pressure entry, or None if the reading should be skipped
+        """
+        try:
+            if int(reading["isManualEntry"]):
+                # Skipping manual entered data
+                logger.info(f"Skipping manual entered data: {reading['timestamp']}")
+                return None
             
-        self._lastSyncTime = int(bpData.get("lastSyncedTime", 0))
-        time = datetime.fromtimestamp(timestamp=self._lastSyncTime / 1000, tz=timezone.utc)
-        
-        ret = []
+            if self._user_number is not None and self._user_number != -1 and self._user_number != int(reading["userNumberInDevice"]):
+                # Skipping data for a different user
+                logger.info(f"Skipping data for a different user: {reading['userNumberInDevice']}")
+                return None
+
+            measurementTimestampMs = int(reading["measurementDate"])
+            measurementDate = datetime.fromtimestamp(timestamp=measurementTimestampMs / 1000, tz=timezone.utc)
+
+            return {
+                "diastolicUnit": reading["diastolicUnit"],
+                "diastolic": reading["diastolic"],
+                "systolicUnit": reading["systolicUnit"],
+                "systolic": reading["systolic"],
+                "pulseUnit": reading["pulseUnit"],
+                "pulse": reading["pulse"],
+                "irregularHB": int(reading["irregularHB"]) != 0,
+                "movementDetect": int(reading["movementDetect"]) != 0,
+                "cuffWrapDetect": int(reading["cuffWrapDetect"]) != 0,
+                "notes": reading.get("notes", ""),
+                "measurementDate": measurementDate,
+                "measurementTimestampMs": measurementTimestampMs,
+                # Pre-seed the datetime cache used by common.get_datetime_from_entry
+                "_dt": measurementDate,
+                "timezone": _fixed_offset(int(reading["timeZone"]) // 60)
+            }
+
+        except KeyError as e:
+            logger.exception(f"Missing mandatory key - skipping: {e}")
+
+        except Exception as e:
+            logger.exception(f"Error parsing blood pressure data - skipping: {e}")
+
+        return None
+
+    def getBloodPressureData(self, nextpaginationKey: int = 0, lastSyncedTime: int = 0, phoneIdentifier: str = ""):
+        """
+        Fetch blood pressure data from the OMRON Connect API.
+
+        This is a generator: pages are requested as the readings are consumed, following nextpaginationKey
+        until the server stops returning one. Each page is requested in the background as soon as the
+        previous page reveals its key, so it downloads while that page's readings are being consumed. If a
+        page fails to load, OmronFetchError is raised so the caller can tell a failure from the end of the data.
+        """
+        if self._login() == False:
+            logger.error("Login failed. Please check your credentials.")
+            return
         
-        for reading in bpData["data"]:
-            try:
-                if int(reading["isManualEntry"]):
-                    # Skipping manual entered data
-                    logger.info(f"Skipping manual entered data: {reading['timestamp']}")
-                    continue
-                
-                if self._user_number is not None and self._user_number != -1 and self._user_number != int(reading["userNumberInDevice"]):
-                    # Skipping data for a different user
-                    logger.info(f"Skipping data for a different user: {reading['userNumberInDevice']}")
-                    continue
-
-                bpDataItem = {
-                    "diastolicUnit": reading["diastolicUnit"],
-                    "diastolic": reading["diastolic"],
-                    "systolicUnit": reading["systolicUnit"],
-                    "systolic": reading["systolic"],
-                    "pulseUnit": reading["pulseUnit"],
-                    "pulse": reading["pulse"],
-                    "irregularHB": int(reading["irregularHB"]) != 0,
-                    "movementDetect": int(reading["movementDetect"]) != 0,
-                    "cuffWrapDetect": int(reading["cuffWrapDetect"]) != 0,
-                    "notes": reading.get("notes", ""),
-                    "measurementDate": datetime.fromtimestamp(timestamp=int(reading["measurementDate"]) / 1000, tz=timezone.utc),
-                    "timezone": pytz.FixedOffset(int(reading["timeZone"]) // 60)
-                }
-                ret.append(bpDataItem)
-
-            except KeyError as e:
-                logger.exception(f"Missing mandatory key - skipping: {e}")
-                continue
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pendingPage = executor.submit(self._getBloodPressurePage, nextpaginationKey, lastSyncedTime, phoneIdentifier)
 
-            except Exception as e:
-                logger.exception(f"Error parsing blood pressure data - skipping: {e}")
-                continue
-                            
-        return ret
+            while pendingPage is not None:
+                bpData = pendingPage.result()
+                if bpData is None:
+                    raise OmronFetchError(f"Failed to fetch blood pressure data page {nextpaginationKey}")
+
+                self._lastSyncTime = int(bpData.get("lastSyncedTime", 0))
+
+                pendingPage = None
+                _nextpaginationKey = int(bpData.get("nextpaginationKey") or 0)
+                if _nextpaginationKey > 0 and _nextpaginationKey != nextpaginationKey:
+                    nextpaginationKey = _nextpaginationKey
+                    pendingPage = executor.submit(self._getBloodPressurePage, nextpaginationKey, lastSyncedTime, phoneIdentifier)
+
+                for reading in bpData["data"]:
+                    bpDataItem = self._parseBloodPressureReading(reading)
+                    if bpDataItem is not None:
+                        yield bpDataItem
 
 
 
@@ -233,7 +293,7 @@ def main():
             omronCredentials = common.getOmronCredentials()
             omron = OmronAPI(_email_address=omronCredentials['email'], _password=omronCredentials['password'], _country_code=omronCredentials['country_code'], _user_number=omronCredentials['user_number'])
             userData = omron.getUserData()
-            ret = omron.getBloodPressureData(nextpaginationKey=0, lastSyncedTime=0)
+            ret = list(omron.getBloodPressureData(nextpaginationKey=0, lastSyncedTime=0))
         
         return 0
             
@@ -1,23 +1,46 @@
 #!/usr/bin/env python3
 
-from flask import Flask
+import os
+from flask import Flask, render_template
 from common import MIGRATION_TYPE
 import common
 
 app = Flask(__name__)
 
+# (state file mtime/size/inode, rendered page) - the page only changes when the migration writes a new state file
+_home_cache = (None, None)
+
+
+def format_migration_date(p_item: MIGRATION_TYPE) -> str:
+    last_migration_date = common.get_last_migration_date(p_item)
+    return last_migration_date.strftime("%x %X") if last_migration_date else "Never"
+
 
 @app.route('/')
 def home():
-    last_fitbit_migration_date = common.get_last_migration_date(MIGRATION_TYPE.FITBIT)
-    last_omron_migration_date = common.get_last_migration_date(MIGRATION_TYPE.OMRON)
-    version = common.get_version()
-    
-    
-    return f'<h1>Hello from metric2garmin ({version})</h1>' \
-           f'<p>Last Fitbit metric migrated: {last_fitbit_migration_date.strftime("%x %X") if last_fitbit_migration_date else "Never"}</p>' \
-           f'<p>Last Omron metric migrated: {last_omron_migration_date.strftime("%x %X") if last_omron_migration_date else "Never"}</p>' \
-
+    global _home_cache
+
+    # The state file is replaced atomically, so a new inode or size catches writes within the mtime granularity
+    try:
+        st = os.stat(common.STATE_FILE)
+        state_key = (st.st_mtime_ns, st.st_size, st.st_ino)
+    except OSError:
+        state_key = None
+
+    cached_key, cached_html = _home_cache
+    if cached_html is not None and cached_key == state_key:
+        return cached_html
+
+    # The migration runs in a separate (cron) process, so pick up its latest state
+    common.invalidate_migration_state()
+    html = render_template(
+        'home.html',
+        version=common.get_version(),
+        last_fitbit_migration_date=format_migration_date(MIGRATION_TYPE.FITBIT),
+        last_omron_migration_date=format_migration_date(MIGRATION_TYPE.OMRON),
+    )
+    _home_cache = (state_key, html)
+    return html
 
 
 def main():
@@ -25,4 +48,4 @@ def main():
     app.run(host='0.0.0.0', port='5070', debug=True)
 
 if __name__ == "__main__":
-    exit(main())
\ No newline at end of file
+    exit(main())
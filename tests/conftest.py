@@ -0,0 +1,23 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The modules live in src/ and are imported by name, as they are inside the container
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+# base_logger opens its log file on import, so point it somewhere writable outside the container
+os.environ.setdefault('LOG_FILE', os.path.join(tempfile.mkdtemp(), 'migration.log'))
+
+import common
+
+
+@pytest.fixture
+def state_file(tmp_path, monkeypatch):
+    """Point the migration state at a temporary file and start each test with an empty cache"""
+    path = tmp_path / 'migration_state.json'
+    monkeypatch.setattr(common, 'STATE_FILE', str(path))
+    common.invalidate_migration_state()
+    yield path
+    common.invalidate_migration_state()
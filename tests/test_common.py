@@ -0,0 +1,100 @@
+from datetime import datetime, timezone
+import stat
+
+import common
+from common import MIGRATION_TYPE
+
+
+def test_get_datetime_from_entry_fitbit_entry():
+    entry = {'date': '2024-01-31', 'time': '07:15:30'}
+
+    assert common.get_datetime_from_entry(entry) == datetime(2024, 1, 31, 7, 15, 30)
+    assert entry['_dt'] == datetime(2024, 1, 31, 7, 15, 30)
+
+
+def test_get_datetime_from_entry_defaults_time():
+    assert common.get_datetime_from_entry({'date': '2024-01-31'}) == datetime(2024, 1, 31, 8, 0, 0)
+
+
+def test_get_datetime_from_entry_non_iso_date():
+    assert common.get_datetime_from_entry({'date': '31 Jan 2024', 'time': '07:15'}) == datetime(2024, 1, 31, 7, 15, 0)
+
+
+def test_get_datetime_from_entry_invalid_date():
+    assert common.get_datetime_from_entry({'date': 'not a date'}) == datetime.min
+
+
+def test_get_datetime_from_entry_omron_entry():
+    measured = datetime(2024, 1, 31, 7, 15, tzinfo=timezone.utc)
+
+    assert common.get_datetime_from_entry({'measurementDate': measured}) == measured
+
+
+def test_get_datetime_from_entry_uses_cached_value():
+    cached = datetime(2020, 1, 1)
+
+    assert common.get_datetime_from_entry({'date': '2024-01-31', '_dt': cached}) is cached
+
+
+def test_get_datetime_from_entry_no_date():
+    assert common.get_datetime_from_entry({}) == datetime.min
+
+
+def test_save_migration_state_writes_file(state_file):
+    last_date = datetime(2024, 1, 31, 7, 15, tzinfo=timezone.utc)
+
+    common.save_migration_state(MIGRATION_TYPE.FITBIT, last_date)
+
+    assert common.json_loads(state_file.read_bytes()) == {'last_fitbit_migration_date': last_date.isoformat()}
+    assert not (state_file.parent / 'migration_state.json.tmp').exists()
+    assert common.get_last_migration_date(MIGRATION_TYPE.FITBIT) == last_date
+
+
+def test_save_migration_state_keeps_other_keys(state_file):
+    state_file.write_bytes(common.json_dumps({'last_omron_migration_date': '2024-01-01T00:00:00+00:00'}))
+    last_date = datetime(2024, 1, 31, 7, 15, tzinfo=timezone.utc)
+
+    common.save_migration_state(MIGRATION_TYPE.FITBIT, last_date, durable=True)
+
+    assert common.json_loads(state_file.read_bytes()) == {
+        'last_omron_migration_date': '2024-01-01T00:00:00+00:00',
+        'last_fitbit_migration_date': last_date.isoformat(),
+    }
+
+
+def test_save_migration_state_updates_cache(state_file):
+    common.save_migration_state(MIGRATION_TYPE.OMRON, datetime(2024, 1, 1, tzinfo=timezone.utc))
+    # Changes made behind the cache's back are only seen after it is invalidated
+    state_file.write_bytes(common.json_dumps({}))
+
+    assert common.get_last_migration_date(MIGRATION_TYPE.OMRON) == datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    common.invalidate_migration_state()
+
+    assert common.get_last_migration_date(MIGRATION_TYPE.OMRON) is None
+
+
+def test_save_migration_state_failed_write_keeps_cache(state_file, monkeypatch):
+    first_date = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    common.save_migration_state(MIGRATION_TYPE.OMRON, first_date)
+    monkeypatch.setattr(common, '_write_migration_state', lambda state, durable: False)
+
+    common.save_migration_state(MIGRATION_TYPE.OMRON, datetime(2024, 2, 1, tzinfo=timezone.utc))
+
+    assert common.get_last_migration_date(MIGRATION_TYPE.OMRON) == first_date
+
+
+def test_save_migration_state_directory_fsync_failure(state_file, monkeypatch):
+    real_fsync = common.os.fsync
+    def fsync(fd):
+        if stat.S_ISDIR(common.os.fstat(fd).st_mode):
+            raise OSError(22, 'Invalid argument')
+        real_fsync(fd)
+    monkeypatch.setattr(common.os, 'fsync', fsync)
+    last_date = datetime(2024, 1, 31, 7, 15, tzinfo=timezone.utc)
+
+    common.save_migration_state(MIGRATION_TYPE.OMRON, last_date, durable=True)
+
+    # The replace already happened, so the cache must follow the file
+    assert common.json_loads(state_file.read_bytes()) == {'last_omron_migration_date': last_date.isoformat()}
+    assert common.get_last_migration_date(MIGRATION_TYPE.OMRON) == last_date
@@ -0,0 +1,125 @@
+from datetime import datetime
+import http.server
+import threading
+
+import pytest
+import requests
+
+import common
+import fitbit_api
+
+
+@pytest.fixture
+def fitbit(tmp_path, monkeypatch):
+    token_file = tmp_path / 'fitbit_tokens.json'
+    token_file.write_bytes(common.json_dumps({'access_token': 'access', 'refresh_token': 'refresh'}))
+    monkeypatch.setattr(fitbit_api, 'TOKEN_FILE', str(token_file))
+    client = fitbit_api.FitbitAPI('client_id', 'client_secret')
+    yield client
+    client._session.close()
+
+
+def rate_limited_response(p_status_code: int, p_remaining: int, p_reset: int) -> requests.Response:
+    response = requests.Response()
+    response.status_code = p_status_code
+    response.headers['fitbit-rate-limit-remaining'] = str(p_remaining)
+    response.headers['fitbit-rate-limit-reset'] = str(p_reset)
+    return response
+
+
+def test_throttle_no_delay_with_headroom(fitbit):
+    fitbit.update_rate_limits(rate_limited_response(200, 100, 600))
+    now = fitbit_api.time.monotonic()
+
+    fitbit.throttle()
+
+    assert fitbit._next_request_at <= now + 0.1
+
+
+def test_throttle_spreads_remaining_calls(fitbit):
+    fitbit.update_rate_limits(rate_limited_response(200, 5, 600))
+    now = fitbit_api.time.monotonic()
+
+    fitbit.throttle()
+
+    # The 600 seconds left in the window are shared between the 5 remaining calls
+    assert now + 119 <= fitbit._next_request_at <= now + 121
+
+
+def test_throttle_ignores_quota_after_reset(fitbit, monkeypatch):
+    fitbit.update_rate_limits(rate_limited_response(200, 1, 600))
+    later = fitbit_api.time.monotonic() + 601
+    monkeypatch.setattr(fitbit_api.time, 'monotonic', lambda: later)
+
+    fitbit.throttle()
+
+    assert fitbit._next_request_at == later
+    assert fitbit._rl_remaining is None
+
+
+def test_rate_limit_sleep_is_not_spread_again(fitbit, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(fitbit_api.time, 'sleep', sleeps.append)
+    response = rate_limited_response(429, 0, 30)
+    fitbit.update_rate_limits(response)
+    now = fitbit_api.time.monotonic()
+
+    assert fitbit.handle_fitbit_rate_limits(response)
+    fitbit.throttle()
+
+    assert sleeps[0] == 30
+    assert fitbit._next_request_at <= now + 31
+
+
+@pytest.fixture
+def fitbit_server(fitbit, monkeypatch):
+    """Serve weight logs from a local server, answering 503 for windows ending on a date in failing_end_dates"""
+    failing_end_dates = set()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.endswith('/profile.json'):
+                self.send_response(503)
+                self.end_headers()
+                return
+            start, end = self.path[:-len('.json')].split('/')[-2:]
+            if end in failing_end_dates:
+                self.send_response(503)
+                self.end_headers()
+                return
+            body = common.json_dumps({'weight': [{'date': end, 'time': '08:00:00', 'weight': 80.0, 'bmi': 25.0}]})
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    monkeypatch.setattr(fitbit_api, 'FITBIT_BASE', base)
+    monkeypatch.setattr(fitbit_api, 'WEIGHT_URL_TEMPLATE', base + "/1/user/-/body/log/weight/date/{}/{}.json")
+
+    # Use the production retry policy over plain HTTP, without the backoff sleeps
+    adapter = fitbit._session.get_adapter('https://')
+    adapter.max_retries = adapter.max_retries.new(backoff_factor=0)
+    fitbit._session.mount('http://', adapter)
+
+    yield failing_end_dates
+    server.shutdown()
+    server.server_close()
+
+
+def test_get_fitbit_body_data_keeps_windows_when_one_fails(fitbit, fitbit_server):
+    fitbit_server.add('2024-03-01')
+
+    entries = fitbit.get_fitbit_body_data(datetime(2024, 1, 1), datetime(2024, 5, 1))
+
+    assert [entry['date'] for entry in entries] == ['2024-01-31', '2024-03-31', '2024-04-30', '2024-05-01']
+
+
+def test_check_fitbit_profile_server_error(fitbit, fitbit_server):
+    assert fitbit.check_fitbit_profile() is False
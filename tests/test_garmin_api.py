@@ -0,0 +1,76 @@
+import pytest
+import requests
+from garth.exc import GarthHTTPError
+from garminconnect import GarminConnectTooManyRequestsError
+
+import garmin_api
+
+
+@pytest.fixture
+def garmin(monkeypatch):
+    # No real waiting: the tests only care about the retry decisions
+    monkeypatch.setattr(garmin_api, 'BACKOFF_BASE', 0.0)
+    monkeypatch.setattr(garmin_api, 'MIN_UPLOAD_INTERVAL', 0.0)
+    return garmin_api.GarminAPI('user@example.com', 'password')
+
+
+def http_error(p_status_code: int) -> GarthHTTPError:
+    response = requests.Response()
+    response.status_code = p_status_code
+    return GarthHTTPError(msg='Error in request', error=requests.HTTPError(response=response))
+
+
+class FlakyCall:
+    """Raises the given errors in turn, then returns the result"""
+    def __init__(self, p_errors, p_result=True):
+        self.errors = list(p_errors)
+        self.result = p_result
+        self.calls = []
+
+    def __call__(self, **kwargs):
+        self.calls.append(kwargs)
+        if self.errors:
+            raise self.errors.pop(0)
+        return self.result
+
+
+def test_call_with_backoff_returns_result(garmin):
+    call = FlakyCall([], p_result={'ok': True})
+
+    assert garmin.call_with_backoff(call, systolic=120) == {'ok': True}
+    assert call.calls == [{'systolic': 120}]
+
+
+def test_call_with_backoff_retries_rate_limits(garmin):
+    call = FlakyCall([GarminConnectTooManyRequestsError('Too many requests'), http_error(429)])
+
+    assert garmin.call_with_backoff(call, systolic=120) is True
+    assert len(call.calls) == 3
+
+
+def test_call_with_backoff_gives_up_after_max_retries(garmin):
+    call = FlakyCall([http_error(429)] * (garmin_api.MAX_RETRIES + 1))
+
+    with pytest.raises(GarthHTTPError):
+        garmin.call_with_backoff(call)
+    assert len(call.calls) == garmin_api.MAX_RETRIES + 1
+
+
+def test_call_with_backoff_does_not_retry_other_errors(garmin):
+    call = FlakyCall([http_error(500)])
+
+    with pytest.raises(GarthHTTPError):
+        garmin.call_with_backoff(call)
+    assert len(call.calls) == 1
+
+
+def test_call_with_backoff_delays_next_upload(garmin, monkeypatch):
+    monkeypatch.setattr(garmin_api, 'BACKOFF_BASE', 10.0)
+    monkeypatch.setattr(garmin, 'throttle', lambda: None)
+    now = garmin_api.time.monotonic()
+
+    garmin.call_with_backoff(FlakyCall([GarminConnectTooManyRequestsError('Too many requests')]))
+
+    # The first retry waits BACKOFF_BASE plus up to BACKOFF_BASE of jitter, and holds back the other uploads too
+    assert garmin._next_upload_at >= now + 10.0
+    assert garmin._next_upload_at <= garmin_api.time.monotonic() + 20.0
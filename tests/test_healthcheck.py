@@ -0,0 +1,42 @@
+import time
+
+import pytest
+
+import healthcheck
+
+
+@pytest.fixture
+def cache_file(tmp_path, monkeypatch):
+    path = tmp_path / 'healthcheck_cache.json'
+    monkeypatch.setattr(healthcheck, 'CACHE_FILE', str(path))
+    monkeypatch.setattr(healthcheck.common, 'isGarminConfigured', lambda: True)
+    monkeypatch.setattr(healthcheck.common, 'isFitbitConfigured', lambda: True)
+    monkeypatch.setattr(healthcheck.common, 'isOmronConfigured', lambda: False)
+    return path
+
+
+def run_main() -> int:
+    with pytest.raises(SystemExit) as exit_info:
+        healthcheck.main()
+    return exit_info.value.code
+
+
+def test_fresh_checks_do_not_rewrite_cache(cache_file, monkeypatch):
+    healthcheck.save_cache({'fitbit': time.time()})
+    saves = []
+    monkeypatch.setattr(healthcheck, 'save_cache', saves.append)
+
+    assert run_main() == 0
+    assert saves == []
+
+
+def test_get_cache_seconds_invalid_value(monkeypatch):
+    monkeypatch.setenv('HEALTHCHECK_CACHE_SECONDS', 'fifteen minutes')
+
+    assert healthcheck.get_cache_seconds() == healthcheck.DEFAULT_CACHE_SECONDS
+
+
+def test_get_cache_seconds(monkeypatch):
+    monkeypatch.setenv('HEALTHCHECK_CACHE_SECONDS', '60')
+
+    assert healthcheck.get_cache_seconds() == 60
@@ -0,0 +1,72 @@
+from datetime import datetime, timezone
+
+import omron_api
+import metrics_migration
+
+
+class FakeGarmin:
+    def __init__(self):
+        self.uploaded = []
+
+    def get_blood_pressure_measurements(self, p_from_date, p_to_date):
+        return []
+
+    def set_blood_pressure(self, p_systolic, p_diastolic, p_pulse, p_timestamp, p_notes):
+        self.uploaded.append(p_timestamp)
+        return True
+
+
+class FakeOmron:
+    """Streams the given readings, then fails if fail is set"""
+    def __init__(self, p_readings, p_fail=False):
+        self.readings = p_readings
+        self.fail = p_fail
+
+    def getBloodPressureData(self, lastSyncedTime=0):
+        yield from self.readings
+        if self.fail:
+            raise omron_api.OmronFetchError("Failed to fetch blood pressure data page 5")
+
+
+def bp_entry(p_measurement_date: datetime) -> dict:
+    return {
+        'systolic': 120,
+        'diastolic': 80,
+        'pulse': 60,
+        'measurementDate': p_measurement_date,
+        'measurementTimestampMs': int(p_measurement_date.timestamp() * 1000),
+    }
+
+
+def migrator(p_monkeypatch, p_omron: FakeOmron) -> metrics_migration.BodyCompositionMigrator:
+    migrator = metrics_migration.BodyCompositionMigrator()
+    migrator._garmin_client = FakeGarmin()
+    migrator._omron_client = p_omron
+    p_monkeypatch.setattr(migrator, 'connect_omron', lambda: True)
+    return migrator
+
+
+def test_upload_concurrently_counts_successes(monkeypatch):
+    bp_migrator = migrator(monkeypatch, FakeOmron([]))
+    entries = [{'id': i} for i in range(100)]
+
+    assert bp_migrator.upload_concurrently(entries, lambda entry: entry['id'] % 4 != 0) == 75
+
+
+def test_migrate_blood_pressure_saves_state(state_file, monkeypatch):
+    measured = datetime(2024, 1, 31, 7, 15, tzinfo=timezone.utc)
+    bp_migrator = migrator(monkeypatch, FakeOmron([bp_entry(measured)]))
+
+    assert bp_migrator.omron2garmin_migrate_blood_pressure()
+    assert bp_migrator._garmin_client.uploaded == [measured]
+    assert metrics_migration.common.get_last_migration_date(metrics_migration.MIGRATION_TYPE.OMRON) == measured
+
+
+def test_migrate_blood_pressure_failed_fetch_keeps_state(state_file, monkeypatch):
+    measured = datetime(2024, 1, 31, 7, 15, tzinfo=timezone.utc)
+    bp_migrator = migrator(monkeypatch, FakeOmron([bp_entry(measured)], p_fail=True))
+
+    assert not bp_migrator.omron2garmin_migrate_blood_pressure()
+    # The readings that did arrive are still uploaded, but the next run has to fetch the rest again
+    assert bp_migrator._garmin_client.uploaded == [measured]
+    assert not state_file.exists()
@@ -0,0 +1,77 @@
+import pytest
+
+import omron_api
+
+
+def bp_reading(p_measurement_date_ms: int) -> dict:
+    return {
+        'isManualEntry': '0',
+        'userNumberInDevice': '1',
+        'measurementDate': str(p_measurement_date_ms),
+        'timeZone': '3600',
+        'diastolicUnit': 'mmHg',
+        'diastolic': '80',
+        'systolicUnit': 'mmHg',
+        'systolic': '120',
+        'pulseUnit': 'bpm',
+        'pulse': '60',
+        'irregularHB': '0',
+        'movementDetect': '0',
+        'cuffWrapDetect': '1',
+    }
+
+
+@pytest.fixture
+def omron(monkeypatch):
+    client = omron_api.OmronAPI('user@example.com', 'password', 'GB', 1)
+    monkeypatch.setattr(client, '_login', lambda: True)
+    return client
+
+
+def serve_pages(p_client, p_monkeypatch, p_pages: dict):
+    """Answer page requests from p_pages (keyed by pagination key); missing pages fail as the real fetch does"""
+    requested = []
+    def get_page(nextpaginationKey, lastSyncedTime, phoneIdentifier):
+        requested.append(nextpaginationKey)
+        return p_pages.get(nextpaginationKey)
+    p_monkeypatch.setattr(p_client, '_getBloodPressurePage', get_page)
+    return requested
+
+
+def test_get_blood_pressure_data_follows_pages(omron, monkeypatch):
+    requested = serve_pages(omron, monkeypatch, {
+        0: {'lastSyncedTime': 1, 'nextpaginationKey': 5, 'data': [bp_reading(1706685300000)]},
+        5: {'lastSyncedTime': 2, 'data': [bp_reading(1706771700000)]},
+    })
+
+    readings = list(omron.getBloodPressureData())
+
+    assert [reading['measurementTimestampMs'] for reading in readings] == [1706685300000, 1706771700000]
+    assert requested == [0, 5]
+    assert omron._lastSyncTime == 2
+
+
+def test_get_blood_pressure_data_raises_on_failed_page(omron, monkeypatch):
+    serve_pages(omron, monkeypatch, {
+        0: {'lastSyncedTime': 1, 'nextpaginationKey': 5, 'data': [bp_reading(1706685300000)]},
+    })
+
+    readings = omron.getBloodPressureData()
+
+    # Readings from the pages that did load are still handed out before the failure surfaces
+    assert next(readings)['measurementTimestampMs'] == 1706685300000
+    with pytest.raises(omron_api.OmronFetchError):
+        next(readings)
+
+
+def test_get_blood_pressure_data_raises_on_failed_first_page(omron, monkeypatch):
+    serve_pages(omron, monkeypatch, {})
+
+    with pytest.raises(omron_api.OmronFetchError):
+        list(omron.getBloodPressureData())
+
+
+def test_get_blood_pressure_data_login_failure(omron, monkeypatch):
+    monkeypatch.setattr(omron, '_login', lambda: False)
+
+    assert list(omron.getBloodPressureData()) == []